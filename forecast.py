@@ -0,0 +1,77 @@
+from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
+
+from desc_lg import DESC_LG
+from desc_lm import DESC_LM
+from desc_ld import DESC_LD
+from desc_od import DESC_OD
+
+def _digital_root(n: int) -> int:
+    # то же, что складывать цифры до одной, но за O(1)
+    return 0 if n == 0 else 1 + (n - 1) % 9
+
+# аргументы — суммы дня, месяца и года, так что таблицы до 10050 хватает
+_R9 = bytes(_digital_root(n) for n in range(10050))
+
+def reduce9(n: int) -> int:
+    return _R9[n] if n < 10050 else _digital_root(n)
+
+def _lg_block(d):
+    y = DESC_LG.get(str(d), {})
+    return (
+        f"✨ *Личный год {d}: {y.get('n','')}*\n_{y.get('d','')}_\n"
+        f"*Рекомендации:* {y.get('r','')}\n"
+        f"*В минусе:* {y.get('m','')}\n\n"
+    )
+
+def _lm_block(d):
+    m = DESC_LM.get(str(d), {})
+    return (
+        f"🌙 *Личный месяц {d}: {m.get('n','')}*\n_{m.get('d','')}_\n"
+        f"*В минусе:* {m.get('m','')}\n"
+    )
+
+# Тексты не меняются во время работы — готовые блоки на каждую цифру,
+# индекс в кортеже = сама цифра
+_OD_BLOCK = tuple(f"🌐 *Общий день {d}:*\n{DESC_OD.get(str(d), '')}\n\n" for d in range(10))
+_LD_BLOCK = tuple(f"📍 *Личный день {d}:*\n{DESC_LD.get(str(d), '')}\n\n" for d in range(10))
+# хвост «год + месяц» зависит только от пары цифр — склеиваем заранее,
+# индекс = lg * 10 + lm
+_TAIL = tuple(
+    _lg_block(lg) + _lm_block(lm)
+    for lg in range(10)
+    for lm in range(10)
+)
+
+class Numbers(NamedTuple):
+    od: int  # общий день
+    lg: int  # личный год
+    lm: int  # личный месяц
+    ld: int  # личный день
+
+def calc_numbers(birth: str, y: int, m: int, d: int) -> Numbers:
+    # дата уже проверена validate_date — достаточно взять день и месяц
+    bd_day, bd_month, _ = birth.split(".")
+    lg = reduce9(int(bd_day) + int(bd_month) + y)
+    lm = reduce9(lg + m)
+    ld = reduce9(lm + d)
+    od = reduce9(d + m + y)
+    return Numbers(od, lg, lm, ld)
+
+_FORECAST_TPL = "📅 *ПРОГНОЗ НА {}*\n\n{}{}{}".format
+
+def render_forecast(birth: str, now: datetime) -> str:
+    return _render(birth, now.year, now.month, now.day)
+
+# текст зависит только от даты рождения и дня; повторные нажатия
+# «Мой прогноз» в тот же день отдают готовую строку
+@lru_cache(maxsize=2048)
+def _render(birth: str, y: int, m: int, d: int) -> str:
+    n = calc_numbers(birth, y, m, d)
+    return _FORECAST_TPL(
+        f"{d:02d}.{m:02d}.{y}",
+        _OD_BLOCK[n.od],
+        _LD_BLOCK[n.ld],
+        _TAIL[n.lg * 10 + n.lm],
+    )
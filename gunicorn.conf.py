@@ -0,0 +1,31 @@
+import os
+
+# gunicorn без аргументов: `gunicorn` из корня репозитория
+wsgi_app = "main:app"
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# Один процесс: индекс пользователей, SQLite-писатель и event loop бота
+# живут в памяти процесса. Параллелизм — потоками, вебхук всё равно
+# только кладёт апдейт в очередь и сразу отвечает.
+workers = 1
+worker_class = "gthread"
+threads = 16
+# Не preload: main при импорте запускает поток с event loop и открывает
+# SQLite — после fork в воркере поток бы пропал. Импорт и setup() идут
+# уже в воркере, состояние и так одно на процесс.
+preload_app = False
+# setup() в post_worker_init ходит в Sheets и Telegram — до ~45 с в худшем
+# случае; gthread-воркер шлёт heartbeat из главного потока, так что
+# запросы этот лимит не задерживают
+timeout = 60
+# Telegram переиспользует соединения к вебхуку
+keepalive = 30
+
+def post_worker_init(worker):
+    import main
+    main.setup()
+
+def worker_exit(server, worker):
+    # пул Sheets ещё жив — выгружаем то, что не успел _flusher
+    import storage
+    storage.flush_on_exit()
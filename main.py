@@ -1,14 +1,14 @@
 import os
-import json
-import base64
+import re
 import logging
 import asyncio
 import threading
-from datetime import datetime, timedelta
+from collections import deque
+from functools import lru_cache
+from datetime import datetime
+from zoneinfo import ZoneInfo
 
-import pytz
-import gspread
-from google.oauth2.service_account import Credentials
+import orjson
 
 from flask import Flask, request
 
@@ -24,11 +24,12 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
+from telegram.request import HTTPXRequest
 
-from desc_lg import DESC_LG
-from desc_lm import DESC_LM
-from desc_ld import DESC_LD
-from desc_od import DESC_OD
+from forecast import render_forecast
+from storage import (
+    get_user, update_user, users_loaded, initial_load, start_background_sync,
+)
 
 # ================= НАСТРОЙКИ =================
 logging.basicConfig(level=logging.INFO)
@@ -36,8 +37,6 @@ log = logging.getLogger(__name__)
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
-GSHEET_ID = os.getenv("GSHEET_ID")
-GOOGLE_SA_JSON_B64 = os.getenv("GOOGLE_SA_JSON_B64")
 
 DEFAULT_TZ = "Asia/Almaty"
 
@@ -49,45 +48,60 @@ CHANGE_TZ = "CHANGE_TZ"
 CHANGE_NOTIFY_TIME = "CHANGE_NOTIFY_TIME"
 READY = "READY"
 
-ROW_SIZE = 9
+# на каждый вызов Telegram при старте: больше, чем connect + read PTB (5 + 5 с),
+# иначе медленный, но живой get_me уронит старт. Загрузка (6 с) и три вызова
+# укладываются в timeout воркера из gunicorn.conf.py (60 с)
+STARTUP_TIMEOUT = 12
+
+# соединений к api.telegram.org (HTTP/2): ответы из разных чатов идут параллельно
+TG_POOL_SIZE = 64
 
 # ================= КЛАВИАТУРЫ =================
-def tz_keyboard():
-    return ReplyKeyboardMarkup(
-        [[KeyboardButton("🇰🇿 Алматы"), KeyboardButton("🇷🇺 Москва")]],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+BTN_FORECAST = "📅 Мой прогноз"
+BTN_CHANGE_TIME = "⏰ Изменить время уведомлений"
+BTN_CHANGE_TZ = "🌍 Изменить часовой пояс"
+BTN_PLAN = "💳 Мой тариф"
+
+# Клавиатуры не меняются за время жизни бота — собираем один раз
+TZ_KB = ReplyKeyboardMarkup(
+    [[KeyboardButton("🇰🇿 Алматы"), KeyboardButton("🇷🇺 Москва")]],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
 
-def time_keyboard():
-    return ReplyKeyboardMarkup(
-        [
-            [KeyboardButton("06:00"), KeyboardButton("08:00")],
-            [KeyboardButton("09:00"), KeyboardButton("11:00")],
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True,
-    )
+TIME_KB = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton("06:00"), KeyboardButton("08:00")],
+        [KeyboardButton("09:00"), KeyboardButton("11:00")],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True,
+)
 
-def main_keyboard():
-    return ReplyKeyboardMarkup(
-        [
-            [KeyboardButton("📅 Мой прогноз")],
-            [KeyboardButton("⏰ Изменить время уведомлений")],
-            [KeyboardButton("🌍 Изменить часовой пояс")],
-            [KeyboardButton("💳 Мой тариф")],
-        ],
-        resize_keyboard=True,
-    )
+MAIN_KB = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(BTN_FORECAST)],
+        [KeyboardButton(BTN_CHANGE_TIME)],
+        [KeyboardButton(BTN_CHANGE_TZ)],
+        [KeyboardButton(BTN_PLAN)],
+    ],
+    resize_keyboard=True,
+)
 
 # ================= УТИЛИТЫ =================
-def normalize_row(r):
-    return r + [""] * (ROW_SIZE - len(r))
+# [0-9], а не \d: \d пропускает и арабские/деванагари цифры
+_DATE_RE = re.compile(r"([0-9]{1,2})\.([0-9]{1,2})\.([0-9]{4})")
 
 def validate_date(text):
+    m = _DATE_RE.fullmatch(text)
+    if not m:
+        return None
+    d, mo, y = map(int, m.groups())
+    if not (1 <= d <= 31 and 1 <= mo <= 12 and 1900 <= y <= 2100):
+        return None
     try:
-        return datetime.strptime(text, "%d.%m.%Y")
-    except:
+        return datetime(y, mo, d)
+    except ValueError:  # 31.02 и т.п.
         return None
 
 def validate_time(text):
@@ -97,156 +111,62 @@ def validate_time(text):
     except:
         return False
 
-def reduce9(n: int) -> int:
-    while n > 9:
-        n = sum(map(int, str(n)))
-    return n
-
-# ================= GOOGLE SHEETS =================
-_ws = None
-
-def get_ws():
-    global _ws
-    if _ws:
-        return _ws
-
-    creds_json = json.loads(base64.b64decode(GOOGLE_SA_JSON_B64).decode())
-    creds = Credentials.from_service_account_info(
-        creds_json,
-        scopes=["https://www.googleapis.com/auth/spreadsheets"],
-    )
-    gc = gspread.authorize(creds)
-    sh = gc.open_by_key(GSHEET_ID)
-
-    try:
-        ws = sh.worksheet("users")
-    except gspread.exceptions.WorksheetNotFound:
-        ws = sh.add_worksheet(title="users", rows=1000, cols=ROW_SIZE)
-        ws.append_row([
-            "user_id",
-            "status",
-            "trial_until",
-            "birth_date",
-            "timezone",
-            "notify_time",
-            "step",
-            "created_at",
-            "updated_at",
-        ])
-
-    _ws = ws
-    return ws
-
-def get_user(update: Update):
-    ws = get_ws()
-    uid = str(update.effective_user.id)
-    rows = ws.get_all_values()
-
-    for r in rows[1:]:
-        if r and r[0] == uid:
-            return normalize_row(r)
-
-    return None
-
-def update_user(update: Update, **fields):
-    ws = get_ws()
-    uid = str(update.effective_user.id)
-    rows = ws.get_all_values()
-    now = datetime.now().strftime("%d.%m.%Y %H:%M")
-
-    col_map = {
-        "status": 2,
-        "trial_until": 3,
-        "birth_date": 4,
-        "timezone": 5,
-        "notify_time": 6,
-        "step": 7,
-    }
-
-    for i, r in enumerate(rows[1:], start=2):
-        if r and r[0] == uid:
-            for k, v in fields.items():
-                if k in col_map:
-                    ws.update_cell(i, col_map[k], v)
-            ws.update_cell(i, 9, now)
-            return normalize_row(ws.row_values(i))
-
-    row = [
-        uid,
-        "trial",
-        (datetime.now() + timedelta(days=3)).strftime("%d.%m.%Y"),
-        "",
-        "",
-        "",
-        WAIT_TZ,
-        datetime.now().strftime("%d.%m.%Y"),
-        now,
-    ]
-    ws.append_row(row)
-    return normalize_row(row)
+_tz = lru_cache(maxsize=32)(ZoneInfo)
+# локальная ссылка вместо поиска атрибута datetime на каждом прогнозе
+_now = datetime.now
 
 # ================= ПРОГНОЗ =================
 async def send_full_forecast(u: Update, row):
     if not row or not row[3]:
         await u.message.reply_text(
             "Сначала укажи дату рождения 🙂",
-            reply_markup=main_keyboard()
+            reply_markup=MAIN_KB
         )
         return
 
-    bd = datetime.strptime(row[3], "%d.%m.%Y")
-    tz = pytz.timezone(row[4] or DEFAULT_TZ)
-    now = datetime.now(tz)
-
-    lg = reduce9(bd.day + bd.month + now.year)
-    lm = reduce9(lg + now.month)
-    ld = reduce9(lm + now.day)
-    od = reduce9(now.day + now.month + now.year)
-
-    msg = f"📅 *ПРОГНОЗ НА {now.strftime('%d.%m.%Y')}*\n\n"
-    msg += f"🌐 *Общий день {od}:*\n{DESC_OD.get(str(od), '')}\n\n"
-    msg += f"📍 *Личный день {ld}:*\n{DESC_LD.get(str(ld), '')}\n\n"
-
-    y = DESC_LG.get(str(lg), {})
-    m = DESC_LM.get(str(lm), {})
-
-    msg += f"✨ *Личный год {lg}: {y.get('n','')}*\n_{y.get('d','')}_\n"
-    msg += f"*Рекомендации:* {y.get('r','')}\n"
-    msg += f"*В минусе:* {y.get('m','')}\n\n"
-
-    msg += f"🌙 *Личный месяц {lm}: {m.get('n','')}*\n_{m.get('d','')}_\n"
-    msg += f"*В минусе:* {m.get('m','')}\n"
+    now = _now(_tz(row[4] or DEFAULT_TZ))
 
     await u.message.reply_text(
-        msg,
+        render_forecast(row[3], now),
         parse_mode="Markdown",
-        reply_markup=main_keyboard()
+        reply_markup=MAIN_KB
     )
 
 # ================= HANDLERS =================
+async def not_loaded_yet(u: Update):
+    # таблица ещё не загружена: «нового» пользователя не заводим —
+    # пустой профиль ушёл бы в таблицу поверх настоящего
+    await u.message.reply_text("Бот перезапускается, попробуй через минуту 🙏")
+
 async def start(u: Update, c: ContextTypes.DEFAULT_TYPE):
     row = get_user(u)
-    if not row:
+    if not row and not users_loaded():
+        await not_loaded_yet(u)
+    elif not row:
         update_user(u, step=WAIT_TZ)
         await u.message.reply_text(
             "Выбери часовой пояс:",
-            reply_markup=tz_keyboard()
+            reply_markup=TZ_KB
         )
     else:
         await u.message.reply_text(
             "Главное меню:",
-            reply_markup=main_keyboard()
+            reply_markup=MAIN_KB
         )
 
 async def handle_msg(u: Update, c: ContextTypes.DEFAULT_TYPE):
     text = u.message.text.strip()
     row = get_user(u)
 
+    if not row and not users_loaded():
+        await not_loaded_yet(u)
+        return
+
     if not row:
         update_user(u, step=WAIT_TZ)
         await u.message.reply_text(
             "Давай начнём сначала 🙂\nВыбери часовой пояс:",
-            reply_markup=tz_keyboard()
+            reply_markup=TZ_KB
         )
         return
 
@@ -259,7 +179,7 @@ async def handle_msg(u: Update, c: ContextTypes.DEFAULT_TYPE):
             update_user(u, timezone=tz, step=next_step)
             await u.message.reply_text(
                 "Выбери время уведомлений:",
-                reply_markup=time_keyboard(),
+                reply_markup=TIME_KB,
             )
         else:
             await u.message.reply_text("Выбери часовой пояс кнопкой.")
@@ -272,34 +192,34 @@ async def handle_msg(u: Update, c: ContextTypes.DEFAULT_TYPE):
             if step == WAIT_NOTIFY_TIME:
                 await u.message.reply_text("Введи дату рождения (ДД.ММ.ГГГГ):")
             else:
-                await u.message.reply_text("Время обновлено.", reply_markup=main_keyboard())
+                await u.message.reply_text("Время обновлено.", reply_markup=MAIN_KB)
         else:
             await u.message.reply_text("Введите время ЧЧ:ММ")
         return
 
     if step == WAIT_BIRTH:
         if validate_date(text):
-            update_user(u, birth_date=text, step=READY)
-            await send_full_forecast(u, get_user(u))
+            row = update_user(u, birth_date=text, step=READY)
+            await send_full_forecast(u, row)
         else:
             await u.message.reply_text("Неверный формат даты.")
         return
 
-    if text == "📅 Мой прогноз":
+    if text == BTN_FORECAST:
         await send_full_forecast(u, row)
         return
 
-    if text == "⏰ Изменить время уведомлений":
+    if text == BTN_CHANGE_TIME:
         update_user(u, step=CHANGE_NOTIFY_TIME)
-        await u.message.reply_text("Введите новое время:", reply_markup=time_keyboard())
+        await u.message.reply_text("Введите новое время:", reply_markup=TIME_KB)
         return
 
-    if text == "🌍 Изменить часовой пояс":
+    if text == BTN_CHANGE_TZ:
         update_user(u, step=CHANGE_TZ)
-        await u.message.reply_text("Выбери часовой пояс:", reply_markup=tz_keyboard())
+        await u.message.reply_text("Выбери часовой пояс:", reply_markup=TZ_KB)
         return
 
-    if text == "💳 Мой тариф":
+    if text == BTN_PLAN:
         await u.message.reply_text(
             f"💳 Тариф: {row[1].upper()}\n"
             f"⏳ До: {row[2]}"
@@ -308,7 +228,19 @@ async def handle_msg(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
 # ================= SERVER =================
 app = Flask(__name__)
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+application = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .request(HTTPXRequest(
+        connection_pool_size=TG_POOL_SIZE,
+        pool_timeout=10,
+        http_version="2",
+    ))
+    # апдейты приходят через наш вебхук, расписаний нет
+    .updater(None)
+    .job_queue(None)
+    .build()
+)
 
 application.add_handler(CommandHandler("start", start))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_msg))
@@ -316,17 +248,79 @@ application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_m
 loop = asyncio.new_event_loop()
 threading.Thread(target=loop.run_forever, daemon=True).start()
 
+# сильные ссылки, чтобы GC не собрал задачи посреди обработки
+_tasks = set()
+# chat_id -> очередь апдейтов; один обработчик на чат сохраняет порядок
+# сообщений внутри чата, а разные чаты не ждут друг друга
+_chat_queues = {}
+
+async def _chat_worker(chat_id, q):
+    try:
+        while q:
+            try:
+                await application.process_update(q.popleft())
+            except Exception:
+                log.exception("Failed to process update for chat %s", chat_id)
+    finally:
+        del _chat_queues[chat_id]
+
+def _dispatch(data):
+    update = Update.de_json(data, application.bot)
+    chat_id = update.effective_chat.id if update.effective_chat else None
+
+    q = _chat_queues.get(chat_id)
+    if q is not None:
+        q.append(update)
+        return
+
+    q = _chat_queues[chat_id] = deque([update])
+    task = loop.create_task(_chat_worker(chat_id, q))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
+    # Telegram нужен только быстрый 200 — обработка идёт в фоне на loop
+    loop.call_soon_threadsafe(_dispatch, orjson.loads(request.get_data(cache=False)))
     return "OK", 200
 
+_setup_lock = threading.Lock()
+_setup_done = False
+
+def _run(coro):
+    fut = asyncio.run_coroutine_threadsafe(coro, loop)
+    try:
+        return fut.result(STARTUP_TIMEOUT)
+    except BaseException:
+        # по таймауту корутина продолжила бы работать в loop — отменяем
+        fut.cancel()
+        raise
+
+def setup():
+    """Однократный старт бота; безопасно вызывать из любого сервера."""
+    global _setup_done
+    with _setup_lock:
+        if _setup_done:
+            return
+
+        # Sheets недоступен — стартуем с локальной SQLite, _refresher догрузит
+        initial_load()
+        _run(application.initialize())
+        _run(application.start())
+        try:
+            _run(application.bot.set_webhook(
+                f"{PUBLIC_URL}/webhook",
+                max_connections=100,
+                allowed_updates=[Update.MESSAGE],
+                connect_timeout=5,
+                read_timeout=5,
+            ))
+        except Exception:
+            # Telegram продолжит слать на ранее установленный вебхук
+            log.exception("set_webhook failed")
+        start_background_sync(loop)
+        _setup_done = True
+
 if __name__ == "__main__":
-    asyncio.run_coroutine_threadsafe(application.initialize(), loop)
-    asyncio.run_coroutine_threadsafe(application.start(), loop)
-    asyncio.run_coroutine_threadsafe(
-        application.bot.set_webhook(f"{PUBLIC_URL}/webhook"),
-        loop,
-    )
+    setup()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
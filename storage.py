@@ -0,0 +1,453 @@
+import os
+import json
+import atexit
+import time
+import base64
+import random
+import asyncio
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timedelta
+
+import gspread
+from gspread.utils import a1_to_rowcol, rowcol_to_a1
+from google.oauth2.service_account import Credentials
+
+from telegram import Update
+
+log = logging.getLogger(__name__)
+
+# ================= НАСТРОЙКИ =================
+GSHEET_ID = os.getenv("GSHEET_ID")
+GOOGLE_SA_JSON_B64 = os.getenv("GOOGLE_SA_JSON_B64")
+DB_PATH = os.getenv("DB_PATH", "users.db")
+
+COLUMNS = [
+    "user_id",
+    "status",
+    "trial_until",
+    "birth_date",
+    "timezone",
+    "notify_time",
+    "step",
+    "created_at",
+    "updated_at",
+]
+ROW_SIZE = len(COLUMNS)
+# бот меняет только эти поля; status и trial_until ведёт админ в таблице
+EDITABLE_FIELDS = COLUMNS[3:7]
+# что выгружаем для уже существующей строки
+SYNC_FIELDS = EDITABLE_FIELDS + ["updated_at"]
+
+# (connect, read) — чтобы зависший Google Sheets не вешал поток навсегда
+SHEETS_TIMEOUT = (3.05, 10)
+# повторы при квоте (429) и сбоях Google (5xx)
+SHEETS_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# выгрузка изменений в Google Sheets
+FLUSH_INTERVAL = 5
+FLUSH_BATCH = 50
+REFRESH_INTERVAL = 300
+FLUSH_TIMEOUT = 60
+# первая загрузка при старте: воркер gunicorn должен подняться за 30 с
+INITIAL_LOAD_TIMEOUT = 6
+# пока первая загрузка не удалась, _refresher повторяет её чаще
+REFRESH_RETRY = 30
+# последняя выгрузка при остановке; меньше graceful_timeout gunicorn (30 с)
+FINAL_FLUSH_TIMEOUT = 20
+
+def normalize_row(r):
+    return r + [""] * (ROW_SIZE - len(r))
+
+# ================= GOOGLE SHEETS =================
+_ws = None
+_ws_lock = threading.Lock()
+# все вызовы gspread — только в этом пуле, чтобы не блокировать event loop.
+# Один поток и один закэшированный клиент = одна keep-alive сессия requests,
+# поэтому TLS к Google не переустанавливается на каждую выгрузку.
+_sheets_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+
+@lru_cache(maxsize=1)
+def _creds():
+    # разбор ключа сервисного аккаунта — один раз; токен обновляется сам
+    creds_json = json.loads(base64.b64decode(GOOGLE_SA_JSON_B64).decode())
+    return Credentials.from_service_account_info(
+        creds_json,
+        scopes=["https://www.googleapis.com/auth/spreadsheets"],
+    )
+
+def get_ws():
+    global _ws
+    if _ws:
+        return _ws
+
+    with _ws_lock:
+        if _ws:
+            return _ws
+
+        gc = gspread.authorize(_creds())
+        gc.set_timeout(SHEETS_TIMEOUT)
+        sh = gc.open_by_key(GSHEET_ID)
+
+        try:
+            ws = sh.worksheet("users")
+        except gspread.exceptions.WorksheetNotFound:
+            ws = sh.add_worksheet(title="users", rows=1000, cols=ROW_SIZE)
+            ws.append_row(COLUMNS)
+
+        _ws = ws
+    return ws
+
+def sheets_call(fn, *args, retry_on=RETRY_STATUSES, **kwargs):
+    """Вызов gspread с экспоненциальной паузой при 429/5xx от Google."""
+    delay = 0.2
+    for attempt in range(1, SHEETS_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            if e.response.status_code not in retry_on or attempt == SHEETS_RETRIES:
+                raise
+            log.warning("Google Sheets %s, retry %d", e.response.status_code, attempt)
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 8)
+
+def reset_ws_on_auth_error(e: Exception):
+    """Сбрасывает закэшированный worksheet, если Google отозвал авторизацию."""
+    global _ws
+    if isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 401:
+        log.warning("Google Sheets auth expired, reconnecting")
+        _ws = None
+
+# ================= ЛОКАЛЬНОЕ ХРАНИЛИЩЕ =================
+# Хендлеры работают только с локальными данными (dict + SQLite). Google Sheets остаётся
+# источником правды: при старте строки загружаются оттуда, а изменения
+# фоновый _flusher выгружает обратно пачками.
+_db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+_db.execute("PRAGMA journal_mode=WAL")
+_db.execute("PRAGMA synchronous=NORMAL")
+_db_lock = threading.Lock()
+_flush_lock = threading.Lock()
+
+_COLS = ", ".join(COLUMNS)
+_COL_IDX = {c: i for i, c in enumerate(COLUMNS)}
+
+@contextmanager
+def _tx():
+    # isolation_level=None — автокоммит на каждый запрос; пачку пишем
+    # одной транзакцией: один fsync и никаких полуприменённых обновлений
+    with _db_lock:
+        _db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            _db.execute("ROLLBACK")
+            raise
+        _db.execute("COMMIT")
+
+_db.execute(f"""
+    CREATE TABLE IF NOT EXISTS users (
+        {" TEXT, ".join(COLUMNS)} TEXT,
+        -- NULL: строки в таблице не было; -1: append отправлен, ответ не дошёл;
+        -- 0: строка пропала из таблицы при последнем обновлении
+        sheet_row INTEGER,
+        dirty INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id)
+    )
+""")
+
+# uid -> строка; горячий путь хендлеров — просто поиск в dict
+_users = {}
+
+def _reload_users():
+    global _users
+    # собираем новый dict и подменяем целиком: хендлеры не увидят полупустой
+    _users = {r[0]: list(r) for r in _db.execute(f"SELECT {_COLS} FROM users")}
+
+_reload_users()
+_loaded = False
+_LAST_COL = rowcol_to_a1(1, ROW_SIZE)[:-1]
+
+def users_loaded():
+    """Была ли хоть одна успешная загрузка из таблицы."""
+    return _loaded
+
+def load_users():
+    global _loaded
+    rows = sheets_call(get_ws().batch_get, [f"A2:{_LAST_COL}"])[0]
+    data = [
+        (*normalize_row(r), i)
+        for i, r in enumerate(rows, start=2)
+        if r and r[0]
+    ]
+    # status/trial_until/created_at и номер строки всегда берём из таблицы,
+    # поля бота — только если нет несохранённых локальных правок. Локальную
+    # строку, которой в таблице не было (sheet_row IS NULL), заменяем целиком:
+    # это пустой профиль, заведённый без таблицы, — он не должен затереть настоящий
+    keep_local = "users.dirty > 0 AND users.sheet_row IS NOT NULL"
+    updates = ", ".join(
+        f"{c} = excluded.{c}" if c not in SYNC_FIELDS else
+        f"{c} = CASE WHEN {keep_local} THEN users.{c} ELSE excluded.{c} END"
+        for c in COLUMNS[1:]
+    )
+    with _tx():
+        # строку могли удалить или пересортировать — старые номера недействительны
+        _db.execute("UPDATE users SET sheet_row = 0 WHERE sheet_row > 0")
+        _db.executemany(
+            f"INSERT INTO users ({_COLS}, sheet_row) "
+            f"VALUES ({', '.join('?' * (ROW_SIZE + 1))}) "
+            f"ON CONFLICT(user_id) DO UPDATE SET {updates}, "
+            f"dirty = CASE WHEN {keep_local} THEN users.dirty ELSE 0 END, "
+            f"sheet_row = excluded.sheet_row",
+            data,
+        )
+        _reload_users()
+    _loaded = True
+    log.info("Loaded %d users from Google Sheets", len(data))
+
+def initial_load():
+    """Загрузка при старте не дольше INITIAL_LOAD_TIMEOUT; при сбое повторит _refresher."""
+    try:
+        _sheets_pool.submit(load_users).result(INITIAL_LOAD_TIMEOUT)
+    except Exception as e:
+        log.exception("Initial Google Sheets load failed, retrying in background")
+        reset_ws_on_auth_error(e)
+
+def get_user(update: Update):
+    r = _users.get(str(update.effective_user.id))
+    return list(r) if r else None
+
+def update_user(update: Update, **fields):
+    uid = str(update.effective_user.id)
+    now_dt = datetime.now()
+    now = now_dt.strftime("%d.%m.%Y %H:%M")
+    fields = {k: v for k, v in fields.items() if k in EDITABLE_FIELDS}
+
+    with _db_lock:
+        row = _users.get(uid)
+        if row:
+            # пишем только то, что реально поменялось
+            fields = {k: v for k, v in fields.items() if row[_COL_IDX[k]] != v}
+            if not fields:
+                return list(row)
+            sets = "".join(f"{k} = ?, " for k in fields)
+            _db.execute(
+                f"UPDATE users SET {sets}updated_at = ?, dirty = dirty + 1 "
+                f"WHERE user_id = ?",
+                (*fields.values(), now, uid),
+            )
+            for k, v in fields.items():
+                row[_COL_IDX[k]] = v
+            row[_COL_IDX["updated_at"]] = now
+            _mark_pending(uid)
+            return list(row)
+
+        row = [
+            uid,
+            "trial",
+            (now_dt + timedelta(days=3)).strftime("%d.%m.%Y"),
+            "",
+            "",
+            "",
+            "",
+            now[:10],
+            now,
+        ]
+        for k, v in fields.items():
+            row[_COL_IDX[k]] = v
+        _db.execute(
+            f"INSERT INTO users ({_COLS}, dirty) "
+            f"VALUES ({', '.join('?' * ROW_SIZE)}, 1)",
+            row,
+        )
+        _users[uid] = row
+    _mark_pending(uid)
+    return list(row)
+
+# сколько разных пользователей изменилось с прошлой выгрузки;
+# при всплеске не ждём FLUSH_INTERVAL, а будим _flusher сразу
+_pending_uids = set()
+# создаётся в _flusher, уже на loop бота: на 3.9 Event привязывается
+# к loop в момент создания, и созданный при импорте на чужом loop не работает
+_flush_now = None
+
+def _mark_pending(uid):
+    _pending_uids.add(uid)
+    if len(_pending_uids) >= FLUSH_BATCH and _flush_now is not None:
+        _flush_now.set()
+
+def flush_users():
+    """Выгружает изменённые строки из SQLite в Google Sheets."""
+    if not _flush_lock.acquire(blocking=False):
+        return  # предыдущая выгрузка ещё идёт
+    try:
+        with _db_lock:
+            dirty = _db.execute(
+                f"SELECT {_COLS}, sheet_row, dirty FROM users WHERE dirty > 0"
+            ).fetchall()
+        if not dirty:
+            return
+
+        ws = get_ws()
+        # сверяем кэшированный номер строки с колонкой A: таблицу могли
+        # отсортировать или удалить строки руками
+        col_a = sheets_call(ws.col_values, 1)
+        row_of = {}
+        for i, v in enumerate(col_a, start=1):
+            row_of.setdefault(v, i)
+
+        known, new, adopt = [], [], []
+        for r in dirty:
+            n = r[ROW_SIZE]
+            if n is None:
+                # своей строки мы не заводили, а в таблице она есть —
+                # правда за таблицей, локальный профиль не выгружаем
+                if r[0] in row_of:
+                    adopt.append((row_of[r[0]], r[0]))
+                else:
+                    new.append(r)
+                continue
+            # -1: прошлый append мог упасть по таймауту, успев вставить
+            # строки, — ищем их, а не добавляем второй раз
+            if n <= 0 or n > len(col_a) or col_a[n - 1] != r[0]:
+                n = row_of.get(r[0])
+            if n:
+                known.append((n, r))
+            else:
+                new.append(r)
+
+        if adopt:
+            got = sheets_call(
+                ws.batch_get, [f"A{n}:{_LAST_COL}{n}" for n, _ in adopt]
+            )
+            sets = ", ".join(f"{c} = ?" for c in COLUMNS[1:])
+            with _tx():
+                for (n, uid), vr in zip(adopt, got):
+                    row = normalize_row(list(vr[0]) if vr else [uid])[:ROW_SIZE]
+                    _db.execute(
+                        f"UPDATE users SET {sets}, sheet_row = ?, dirty = 0 "
+                        f"WHERE user_id = ?",
+                        (*row[1:], n, uid),
+                    )
+                    _users[uid] = row
+            log.warning("Took %d users from Google Sheets instead of local rows", len(adopt))
+
+        if known:
+            # только поля бота: правки админа в status/trial_until не затираем.
+            # birth_date..step идут подряд (D:G) — один диапазон, плюс updated_at (I)
+            first, last = _COL_IDX[EDITABLE_FIELDS[0]], _COL_IDX[EDITABLE_FIELDS[-1]]
+            upd = _COL_IDX["updated_at"]
+            ranges = []
+            for n, r in known:
+                ranges.append({
+                    "range": f"{rowcol_to_a1(n, first + 1)}:{rowcol_to_a1(n, last + 1)}",
+                    "values": [list(r[first:last + 1])],
+                })
+                ranges.append({
+                    "range": rowcol_to_a1(n, upd + 1),
+                    "values": [[r[upd]]],
+                })
+            # RAW: строки читаем обратно как текст; USER_ENTERED превратил бы
+            # "08:00" и "01.01.1990" в значения с форматом локали таблицы
+            sheets_call(ws.batch_update, ranges, value_input_option="RAW")
+
+        placed = []
+        if new:
+            # помечаем до запроса: при таймауте строки могли вставиться
+            with _tx():
+                _db.executemany(
+                    "UPDATE users SET sheet_row = -1 WHERE user_id = ?",
+                    [(r[0],) for r in new],
+                )
+            # 5xx мог прийти уже после вставки — повтор задублирует строки
+            resp = sheets_call(
+                ws.append_rows,
+                [list(r[:ROW_SIZE]) for r in new],
+                value_input_option="RAW",
+                retry_on={429},
+            )
+            first_cell = resp["updates"]["updatedRange"].split("!")[-1].split(":")[0]
+            first_row = a1_to_rowcol(first_cell)[0]
+            placed = [(first_row + k, r[0]) for k, r in enumerate(new)]
+        placed += [(n, r[0]) for n, r in known]
+
+        with _tx():
+            _db.executemany(
+                "UPDATE users SET sheet_row = ? WHERE user_id = ?", placed
+            )
+            # если строку успели поменять во время выгрузки — она останется dirty
+            _db.executemany(
+                "UPDATE users SET dirty = 0 WHERE user_id = ? AND dirty = ?",
+                [(r[0], r[-1]) for r in dirty],
+            )
+        log.info("Flushed %d users to Google Sheets", len(known) + len(new))
+    finally:
+        _flush_lock.release()
+
+async def _refresher():
+    # подтягиваем правки, сделанные руками прямо в таблице
+    while True:
+        await asyncio.sleep(REFRESH_INTERVAL if _loaded else REFRESH_RETRY)
+        try:
+            await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(_sheets_pool, load_users),
+                FLUSH_TIMEOUT,
+            )
+        except Exception as e:
+            log.exception("Google Sheets refresh failed")
+            reset_ws_on_auth_error(e)
+
+async def _flusher():
+    global _flush_now
+    _flush_now = asyncio.Event()
+    while True:
+        try:
+            await asyncio.wait_for(_flush_now.wait(), FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _flush_now.clear()
+        _pending_uids.clear()
+        try:
+            await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(_sheets_pool, flush_users),
+                FLUSH_TIMEOUT,
+            )
+        except Exception as e:
+            log.exception("Google Sheets flush failed")
+            reset_ws_on_auth_error(e)
+
+def flush_on_exit():
+    """Последняя выгрузка несохранённых строк перед остановкой процесса."""
+    try:
+        fut = _sheets_pool.submit(flush_users)
+    except RuntimeError:
+        # из atexit пул уже остановлен интерпретатором — выгружаем сами
+        fut = None
+    try:
+        if fut is None:
+            flush_users()
+        else:
+            fut.result(FINAL_FLUSH_TIMEOUT)
+    except Exception:
+        log.exception("Final Google Sheets flush failed")
+
+_bg_tasks = []
+
+def _on_task_done(fut):
+    # задачи бесконечные — любое завершение означает, что синхронизация встала
+    if fut.cancelled():
+        log.error("Background sync task cancelled")
+    else:
+        log.error("Background sync task died", exc_info=fut.exception())
+
+def start_background_sync(loop):
+    """Запускает выгрузку и периодическое обновление на loop бота."""
+    for coro in (_flusher(), _refresher()):
+        fut = asyncio.run_coroutine_threadsafe(coro, loop)
+        fut.add_done_callback(_on_task_done)
+        _bg_tasks.append(fut)
+    atexit.register(flush_on_exit)